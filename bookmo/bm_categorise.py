@@ -0,0 +1,236 @@
+"""
+Bookiemoney module to categorise transactions according to a rules file
+
+The rules are compiled once so that the cost of categorising a transaction
+doesn't depend on the number of rules: payee substrings are all searched at
+once by an Aho-Corasick automaton, creditor and counterpart IDs are looked up
+in dictionaries, and amount ranges are looked up by bisection.
+"""
+
+import bisect
+import collections
+import decimal
+import heapq
+import logging
+import yaml
+
+# the criteria of a rule which are looked up in the given transaction field
+INDEXED_CRITERIA = {
+    'creditor_id': 'transaction_creditor_id',
+    'counterpart_id': 'transaction_counterpart_id',
+}
+
+
+def read_rules_file(rules_file):
+    """
+    Read a rules file and compile it into a categoriser
+    """
+    logging.info("Reading rules file '{rf}'".format(rf=rules_file))
+    with open(rules_file, mode='r') as yfd:
+        rules_config = yaml.safe_load(yfd)
+    return Categoriser(rules_config['rules'])
+
+
+class Categoriser():
+    """
+    Callable object setting category and tags of a transaction according to
+    the first matching rule
+
+    Each rule has a category and/or tags, and one or more criteria which must
+    all match:
+    * payee: substring(s) of the counterpart name, ignoring case
+    * creditor_id: creditor ID(s) of the transaction
+    * counterpart_id: counterpart ID(s) of the transaction, e.g. IBANs
+    * amount: a dictionary with a 'min' and/or a 'max' amount (inclusive)
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        self.payees = SubstringMatcher()
+        self.indexes = {x: collections.defaultdict(set)
+                        for x in INDEXED_CRITERIA}
+        self.amounts = {}
+        # rules without payee or ID criterion are indexed by amount range,
+        # rules without any criterion at all match any amount
+        amount_rules = []
+
+        for index, rule in enumerate(rules):
+            indexed = False
+            if 'payee' in rule:
+                for payee in as_list(rule['payee']):
+                    self.payees.add(payee.casefold(), index)
+                indexed = True
+            for criterion in INDEXED_CRITERIA:
+                if criterion in rule:
+                    for value in as_list(rule[criterion]):
+                        self.indexes[criterion][normalize_id(value)].add(
+                            index)
+                    indexed = True
+            if 'amount' in rule:
+                self.amounts[index] = (
+                    decimal.Decimal(str(rule['amount']['min']))
+                    if 'min' in rule['amount'] else None,
+                    decimal.Decimal(str(rule['amount']['max']))
+                    if 'max' in rule['amount'] else None)
+            if not indexed:
+                amount_rules.append(index)
+        self.payees.compile()
+        self.amount_ranges = AmountRanges(
+            (x, self.amounts.get(x, (None, None))) for x in amount_rules)
+
+        logging.debug("Compiled {rn} categorisation rules".format(
+            rn=len(rules)))
+
+    def __call__(self, transaction):
+        matches = {}
+        if 'transaction_counterpart_name' in transaction:
+            matches['payee'] = self.payees(
+                transaction['transaction_counterpart_name'].casefold())
+        else:
+            matches['payee'] = set()
+        for criterion, field in INDEXED_CRITERIA.items():
+            matches[criterion] = self.indexes[criterion].get(
+                normalize_id(transaction.get(field, '')), set())
+
+        # both the indexed candidates and the ones of the amount range are
+        # sorted, so that the first matching rule can be found by merging them
+        candidates = heapq.merge(
+            sorted(set().union(*matches.values())),
+            self.amount_ranges(transaction['transaction_amount']))
+        for index in candidates:
+            if self.match(index, matches, transaction):
+                rule = self.rules[index]
+                if 'category' in rule:
+                    transaction['transaction_category'] = rule['category']
+                if 'tags' in rule:
+                    transaction['transaction_tags'] = ' '.join(
+                        as_list(rule['tags']))
+                break
+        return transaction
+
+    def match(self, index, matches, transaction):
+        """
+        Check if all criteria of the rule at the given index match
+        """
+        rule = self.rules[index]
+        for criterion in matches:
+            if criterion in rule and index not in matches[criterion]:
+                return False
+        if index in self.amounts:
+            amount = transaction['transaction_amount']
+            min_amount, max_amount = self.amounts[index]
+            if min_amount is not None and amount < min_amount:
+                return False
+            if max_amount is not None and amount > max_amount:
+                return False
+        return True
+
+
+class AmountRanges():
+    """
+    Index of the amount ranges of rules, calling it with an amount returns
+    the sorted indexes of the rules whose range contains the amount
+
+    The boundaries of all ranges split the amounts into elementary intervals,
+    each boundary being an interval of its own as ranges are inclusive, so
+    that the rules of each interval can be computed once and the interval of
+    an amount found by bisection.
+    """
+    def __init__(self, ranges):
+        ranges = list(ranges)
+        self.boundaries = sorted(set(
+            x for _, y in ranges for x in y if x is not None))
+        # interval 2*i is below boundary i and interval 2*i+1 is boundary i
+        intervals = list([] for _ in range(2 * len(self.boundaries) + 1))
+        for index, (min_amount, max_amount) in sorted(ranges):
+            if min_amount is None:
+                first = 0
+            else:
+                first = self.get_interval(min_amount)
+            if max_amount is None:
+                last = len(intervals) - 1
+            else:
+                last = self.get_interval(max_amount)
+            for interval in range(first, last + 1):
+                intervals[interval].append(index)
+        self.intervals = list(tuple(x) for x in intervals)
+
+    def get_interval(self, amount):
+        """
+        Returns the number of the elementary interval containing the amount
+        """
+        position = bisect.bisect_left(self.boundaries, amount)
+        if (position < len(self.boundaries)
+                and self.boundaries[position] == amount):
+            return 2 * position + 1
+        return 2 * position
+
+    def __call__(self, amount):
+        return self.intervals[self.get_interval(amount)]
+
+
+class SubstringMatcher():
+    """
+    Aho-Corasick automaton finding all substrings contained in a text
+
+    Substrings are added with a value, calling the compiled object with a
+    text returns the set of values of all substrings found in one pass
+    over the text.
+    """
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.values = [set()]
+
+    def add(self, substring, value):
+        state = 0
+        for char in substring:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.values.append(set())
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.values[state].add(value)
+
+    def compile(self):
+        """
+        Compute the failure links, breadth first from the root
+        """
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.values[next_state] |= self.values[
+                    self.fail[next_state]]
+
+    def __call__(self, text):
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            found |= self.values[state]
+        return found
+
+
+def as_list(value):
+    """
+    Returns the value as list, if it's a single value
+    """
+    if isinstance(value, list):
+        return value
+    else:
+        return [value]
+
+
+def normalize_id(value):
+    """
+    Normalize an ID like an IBAN, removing spaces and ignoring case
+    """
+    return str(value).replace(' ', '').upper()
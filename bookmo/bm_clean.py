@@ -3,9 +3,10 @@ Bookiemoney module to clean an account statement and its transactions
 before writing it down.
 """
 
+import babel
+import babel.core as babelcore
 import babel.numbers as babelnum
 import babel.dates as babeldate
-import locale
 import logging
 import os
 
@@ -34,15 +35,21 @@ def clean_account_statement(account_statement):
     flavour_config = account_statement['flavour']
     account_uid = account_statement['account_uid']
 
+    logging.info(
+        "Cleaning account file '{af}' for account '{ac}'".format(
+            af=account_file, ac=account_uid))
+    # the values describing the statement are cleaned even if there are no
+    # transactions, e.g. its date range is still needed for the ledger
+    for file_key in account_statement:
+        if file_key != 'transactions':
+            account_statement[file_key] = clean_value(
+                file_key, account_statement[file_key], flavour_config)
     if not account_statement['transactions']:
         logging.warning(
             "Account file '{af}' didn't contain transactions "
             "for account '{ac}'".format(af=account_file, ac=account_uid))
         return account_statement
-    else:
-        logging.info(
-            "Cleaning account file '{af}' for account '{ac}'".format(
-                af=account_file, ac=account_uid))
+
     # determine the default currency from, in decreasing order of priority:
     # 1. the file's account currency
     # 2. the currency defined by the flavour config
@@ -54,10 +61,6 @@ def clean_account_statement(account_statement):
                 'currency', get_locale_currency_code(
                     flavour_config.get('locale')))),
         flavour_config)
-    for file_key in account_statement:
-        if file_key != 'transactions':
-            account_statement[file_key] = clean_value(
-                file_key, account_statement[file_key], flavour_config)
     for line in account_statement['transactions']:
         clean_transaction(line, flavour_config, account_uid, default_currency)
 
@@ -180,13 +183,32 @@ def clean_value(key, value, cfg):
 def get_locale_currency_code(given_locale=None):
     """
     Returns the 3-letters currency code of the given locale or the current one
+
+    The currency is taken from Babel's CLDR data for the territory of the
+    locale, or the most likely territory if the locale is only a language
+    (and possibly a script), so that the process-global locale is never
+    modified and the function is thread-safe.
+    Returns an empty string if there is no locale, as in the C locale.
     """
-    curr_locale = locale.getlocale()
-    if given_locale:
-        locale.setlocale(locale.LC_ALL, (given_locale, curr_locale[1]))
-    else:
-        locale.setlocale(locale.LC_ALL, curr_locale)
-    currency = locale.localeconv()['int_curr_symbol']
-    # else we might not be able to find back the current locale
-    locale.setlocale(locale.LC_ALL, curr_locale)
-    return currency
+    if not given_locale:
+        given_locale = babel.default_locale('LC_MONETARY')
+        # Babel maps the C resp. POSIX locale to en_US_POSIX
+        if not given_locale or given_locale == 'en_US_POSIX':
+            return ''
+    cldr_locale = babel.Locale.parse(given_locale)
+    territory = cldr_locale.territory
+    if not territory:
+        likely_subtags = babelcore.get_global('likely_subtags')
+        likely_locale = None
+        if cldr_locale.script:
+            likely_locale = likely_subtags.get('{la}_{sc}'.format(
+                la=cldr_locale.language, sc=cldr_locale.script))
+        if not likely_locale:
+            likely_locale = likely_subtags.get(cldr_locale.language)
+        if likely_locale:
+            territory = babel.Locale.parse(likely_locale).territory
+    if territory:
+        currencies = babelnum.get_territory_currencies(territory)
+        if currencies:
+            return currencies[0]
+    return ''
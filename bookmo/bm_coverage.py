@@ -0,0 +1,199 @@
+"""
+Bookiemoney module to keep track of the statements already ingested
+
+For each account, a ledger directory holds the transactions already combined,
+as a run file, and a coverage index of the date ranges of the statements they
+come from. Statement files whose date range is already covered can then be
+skipped, and only the uncovered days of the other ones are combined with the
+ledger.
+"""
+
+import bisect
+import datetime
+import glob
+import logging
+import os
+import tempfile
+import urllib.parse
+import yaml
+
+from bookmo import bm_clean
+from bookmo import bm_merge
+
+# suffixes of the files in the ledger directory
+COVERAGE_SUFFIX = '.coverage.yml'
+LEDGER_SUFFIX = '.run'
+
+ONE_DAY = datetime.timedelta(days=1)
+
+
+class CoverageIndex():
+    """
+    Index of the date ranges of the statements already ingested per account,
+    persisted in the ledger directory
+
+    The date ranges of each account are kept sorted and merged, as a list of
+    (begin, end) tuples of inclusive dates.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.intervals = {}
+        self.counts = {}
+        for coverage_file in glob.glob(
+                os.path.join(directory, '*' + COVERAGE_SUFFIX)):
+            with open(coverage_file, mode='r') as yfd:
+                coverage = yaml.safe_load(yfd)
+            self.intervals[coverage['account_uid']] = list(
+                (x['begin'], x['end']) for x in coverage['intervals'])
+            self.counts[coverage['account_uid']] = coverage[
+                'transactions_count']
+        logging.debug("Coverage index read from '{di}': {ci}".format(
+            di=directory, ci=self.intervals))
+
+    def get_path(self, account_uid, suffix):
+        """
+        Returns the path of a ledger file of the account with the suffix
+        """
+        return os.path.join(self.directory,
+                            urllib.parse.quote(account_uid, safe='') + suffix)
+
+    def covers(self, account_uid, begin, end):
+        """
+        Check if the date range from begin to end is completely covered
+        """
+        intervals = self.intervals.get(account_uid, [])
+        index = bisect.bisect_right(intervals, (begin, datetime.date.max))
+        return index > 0 and intervals[index - 1][1] >= end
+
+    def covers_statement(self, account_uid, account_statement):
+        """
+        Check if the range of a statement, as read from the file, is covered
+
+        The statement's begin and end dates are cleaned according to the
+        statement's flavour, a statement without range is never covered.
+        """
+        if ('statement_begin_date' not in account_statement
+                or 'statement_end_date' not in account_statement):
+            return False
+        begin, end = (
+            bm_clean.clean_value(x, account_statement[x],
+                                 account_statement['flavour'])
+            for x in ('statement_begin_date', 'statement_end_date'))
+        return self.covers(account_uid, begin, end)
+
+    def add(self, account_uid, begin, end):
+        """
+        Add a date range to the coverage of the account, merging it with
+        overlapping or adjacent ranges
+        """
+        intervals = self.intervals.setdefault(account_uid, [])
+        merged = []
+        for interval in intervals:
+            if interval[1] + ONE_DAY < begin or end + ONE_DAY < interval[0]:
+                merged.append(interval)
+            else:
+                begin = min(begin, interval[0])
+                end = max(end, interval[1])
+        merged.append((begin, end))
+        intervals[:] = sorted(merged)
+
+    def save(self, account_uid):
+        """
+        Write the coverage of the account to the ledger directory
+        """
+        coverage = {
+            'account_uid': account_uid,
+            'transactions_count': self.counts.get(account_uid, 0),
+            'intervals': list({'begin': x, 'end': y}
+                              for x, y in self.intervals.get(account_uid, [])),
+        }
+        with open(self.get_path(account_uid, COVERAGE_SUFFIX),
+                  mode='w') as yfd:
+            yaml.safe_dump(coverage, yfd)
+
+    def remove_covered_transactions(self, account_statement):
+        """
+        Remove from a cleaned statement the transactions of days already
+        covered, so that it only contributes its uncovered days
+        """
+        account_uid = account_statement['account_uid']
+        if account_uid not in self.intervals:
+            return account_statement
+        transactions = list(
+            x for x in account_statement['transactions']
+            if not self.covers(account_uid, x['transaction_date'],
+                               x['transaction_date']))
+        removed = len(account_statement['transactions']) - len(transactions)
+        if removed:
+            logging.info(
+                "Removed {tn} transactions of covered days from statement "
+                "file '{sf}'".format(
+                    tn=removed,
+                    sf=os.path.basename(account_statement['file'])))
+        account_statement['transactions'] = transactions
+        return account_statement
+
+    def get_ledger(self, account_uid, statements):
+        """
+        Returns the ledger of the account to be extended by the statements
+        """
+        ranges = list(
+            (x['statement_begin_date'], x['statement_end_date'])
+            for x in statements
+            if 'statement_begin_date' in x and 'statement_end_date' in x)
+        return AccountLedger(self, account_uid, ranges)
+
+
+class AccountLedger():
+    """
+    Ledger of the transactions already combined for one account
+
+    Called with the newly combined transactions of the account, it writes
+    them to the ledger as they pass through, and only replaces the previous
+    ledger and extends the coverage once all transactions went through.
+    """
+    def __init__(self, coverage, account_uid, ranges):
+        self.coverage = coverage
+        self.account_uid = account_uid
+        self.ranges = ranges
+        self.ledger_file = coverage.get_path(account_uid, LEDGER_SUFFIX)
+
+    def get_statement(self, in_memory=True):
+        """
+        Returns the previous ledger as a statement, with its transactions
+        either in memory or as a run, or None if there is no ledger yet
+        """
+        if not os.path.exists(self.ledger_file):
+            return None
+        logging.info("Reading ledger file '{lf}'".format(lf=self.ledger_file))
+        statement = {'file': self.ledger_file,
+                     'account_uid': self.account_uid}
+        if in_memory:
+            statement['transactions'] = list(
+                bm_merge.read_run(self.ledger_file))
+        else:
+            statement['run'] = self.ledger_file
+            statement['transactions_count'] = self.coverage.counts.get(
+                self.account_uid, 0)
+        return statement
+
+    def __call__(self, transactions):
+        fd, new_ledger_file = tempfile.mkstemp(
+            suffix=LEDGER_SUFFIX, dir=self.coverage.directory)
+        count = 0
+        try:
+            with open(fd, mode='wb') as run_fd:
+                run_writer = bm_merge.RunWriter(run_fd)
+                for transaction in transactions:
+                    run_writer.write(transaction)
+                    count += 1
+                    yield transaction
+            os.replace(new_ledger_file, self.ledger_file)
+        finally:
+            if os.path.exists(new_ledger_file):
+                os.remove(new_ledger_file)
+        for begin, end in self.ranges:
+            self.coverage.add(self.account_uid, begin, end)
+        self.coverage.counts[self.account_uid] = count
+        self.coverage.save(self.account_uid)
+        logging.info("Ledger file '{lf}' written".format(lf=self.ledger_file))
@@ -0,0 +1,242 @@
+"""
+Bookiemoney module to journal a batch run so that it can be resumed
+
+The journal records, in a directory, which input files have been read and
+cleaned, keeping their cleaned statements, and which accounts have been
+written. Input files which failed are quarantined with their error, so that
+a resumed run only redoes what failed or changed.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+import yaml
+
+from bookmo import bm_read_csv as bm_read
+
+JOURNAL_FILE = 'journal.yml'
+JOURNAL_LOG = 'journal.log'
+STATEMENTS_SUFFIX = '.statements'
+
+# status of the inputs and accounts in the journal
+DONE = 'done'
+QUARANTINED = 'quarantined'
+FAILED = 'failed'
+
+
+def run_isolated(task):
+    """
+    Run a task, a tuple of a key, a function and its arguments, catching any
+    error so that one failing task doesn't abort the whole batch
+
+    Returns a tuple of the key, the result and the error message, which is
+    None if the task succeeded
+    """
+    key, function, arguments = task
+    try:
+        return key, function(*arguments), None
+    except Exception as exc:
+        error = "{ty}: {ex}".format(ty=type(exc).__name__, ex=exc)
+        logging.error("Task '{ke}' failed with '{er}'".format(
+            ke=key, er=error))
+        logging.debug("Traceback of task '{ke}'".format(ke=key),
+                      exc_info=True)
+        return key, None, error
+
+
+def get_file_signature(file):
+    """
+    Returns a signature of the file (or of the archive containing it),
+    which changes if the file is changed
+    """
+    archive, member = bm_read.split_archive_path(file)
+    try:
+        stat = os.stat(archive)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class RunJournal():
+    """
+    Journal of a batch run, persisted in a directory
+
+    The journal file itself is a YAML file so that errors can easily be
+    checked, the cleaned statements of each input file are kept next to it,
+    as spilled by bm_merge. If the run isn't resumed, the files kept by a
+    previous journal are removed and the journal starts afresh.
+
+    So that the journal doesn't need to be rewritten after each task, each
+    change is appended as one JSON line to a log file, which is replayed
+    when reading the journal and compacted into the journal file on save.
+    """
+    def __init__(self, directory, resume=False):
+        self.directory = directory
+        self.journal_file = os.path.join(directory, JOURNAL_FILE)
+        self.log_file = os.path.join(directory, JOURNAL_LOG)
+        self.log_fd = None
+        self.inputs = {}
+        self.accounts = {}
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, mode='r') as yfd:
+                journal = yaml.safe_load(yfd)
+            self.inputs = journal['inputs']
+            self.accounts = journal['accounts']
+        self.replay_log()
+        if resume and (self.inputs or self.accounts):
+            logging.info("Resuming from journal file '{jf}'".format(
+                jf=self.journal_file))
+        elif self.inputs or self.accounts:
+            logging.info("Clearing journal file '{jf}'".format(
+                jf=self.journal_file))
+            for file in list(self.inputs):
+                self.forget_input(file)
+            self.accounts = {}
+        # the log is compacted first, so that new changes don't follow a
+        # line cut by a crash
+        if os.path.exists(self.log_file) or (
+                not resume and os.path.exists(self.journal_file)):
+            self.save()
+
+    def replay_log(self):
+        """
+        Apply the changes of the log file to the journal read from the
+        journal file, ignoring a last line cut by a crash
+        """
+        if not os.path.exists(self.log_file):
+            return
+        with open(self.log_file, mode='r') as lfd:
+            for line in lfd:
+                try:
+                    section, key, entry = json.loads(line)
+                except ValueError:
+                    logging.warning("Ignoring incomplete line in journal log "
+                                    "'{lf}'".format(lf=self.log_file))
+                    break
+                records = getattr(self, section)
+                if entry is None:
+                    records.pop(key, None)
+                else:
+                    records[key] = entry
+
+    def log(self, section, key, entry=None):
+        """
+        Append a change of an input or account entry to the log file, so
+        that it's persisted as soon as the task is done
+        """
+        if self.log_fd is None:
+            self.log_fd = open(self.log_file, mode='a')
+        self.log_fd.write(json.dumps([section, key, entry]) + '\n')
+        self.log_fd.flush()
+
+    def save(self):
+        """
+        Write the journal file, replacing the previous one only once written,
+        and remove the log file whose changes are now in the journal file
+        """
+        fd, journal_file = tempfile.mkstemp(suffix='.yml', dir=self.directory)
+        with open(fd, mode='w') as yfd:
+            yaml.safe_dump({'inputs': self.inputs, 'accounts': self.accounts},
+                           yfd)
+        os.replace(journal_file, self.journal_file)
+        if self.log_fd is not None:
+            self.log_fd.close()
+            self.log_fd = None
+        if os.path.exists(self.log_file):
+            os.remove(self.log_file)
+
+    def get_statements(self, file, flavour):
+        """
+        Returns the cleaned statements of an unchanged input file which was
+        already successfully handled, else None
+        """
+        entry = self.inputs.get(file)
+        if (entry and entry['status'] == DONE
+                and entry['flavour'] == flavour
+                and entry['signature'] == get_file_signature(file)):
+            with open(entry['statements'], mode='rb') as fd:
+                return pickle.load(fd)
+        return None
+
+    def record_input(self, file, flavour, statements=None, error=None):
+        """
+        Record the cleaned statements of an input file, or quarantine it with
+        its error
+        """
+        self.forget_input(file)
+        entry = {'flavour': flavour, 'signature': get_file_signature(file)}
+        if error is None:
+            fd, statements_file = tempfile.mkstemp(suffix=STATEMENTS_SUFFIX,
+                                                   dir=self.directory)
+            with open(fd, mode='wb') as sfd:
+                pickle.dump(statements, sfd, protocol=pickle.HIGHEST_PROTOCOL)
+            entry['status'] = DONE
+            entry['statements'] = statements_file
+        else:
+            logging.error("Quarantining input file '{fi}'".format(fi=file))
+            entry['status'] = QUARANTINED
+            entry['error'] = error
+        self.inputs[file] = entry
+        self.log('inputs', file, entry)
+
+    def forget_input(self, file):
+        """
+        Remove the cleaned statements previously kept for an input file
+        """
+        entry = self.inputs.pop(file, None)
+        if entry:
+            self.log('inputs', file)
+        if (entry and entry['status'] == DONE
+                and os.path.exists(entry['statements'])):
+            with open(entry['statements'], mode='rb') as fd:
+                statements = pickle.load(fd)
+            for statement in statements:
+                if os.path.exists(statement['run']):
+                    os.remove(statement['run'])
+            os.remove(entry['statements'])
+
+    def get_quarantined(self, inputs):
+        """
+        Returns a dictionary of the quarantined inputs with their error
+        """
+        return {x: self.inputs[x]['error'] for x in inputs
+                if self.inputs.get(x, {}).get('status') == QUARANTINED}
+
+    def get_account_signature(self, statements, *options):
+        """
+        Returns a signature of an account made of its input files and of the
+        options used to write it
+        """
+        inputs = sorted(set(x['file'] for x in statements))
+        signature = repr(([(x, self.inputs[x]['signature']) for x in inputs],
+                          options))
+        return hashlib.sha256(signature.encode()).hexdigest()
+
+    def get_account_outputs(self, account_uid, signature):
+        """
+        Returns the output files of an account already written with the same
+        signature, if they all still exist, else None
+        """
+        entry = self.accounts.get(account_uid)
+        if (entry and entry['status'] == DONE
+                and entry['signature'] == signature
+                and all(os.path.exists(x) for x in entry['outputs'])):
+            return entry['outputs']
+        return None
+
+    def record_account(self, account_uid, signature, outputs=None,
+                       error=None):
+        """
+        Record the output files written for an account, or its error
+        """
+        if error is None:
+            self.accounts[account_uid] = {
+                'status': DONE, 'signature': signature,
+                'outputs': outputs or []}
+        else:
+            self.accounts[account_uid] = {
+                'status': FAILED, 'signature': signature, 'error': error}
+        self.log('accounts', account_uid, self.accounts[account_uid])
@@ -0,0 +1,186 @@
+"""
+Bookiemoney module to combine account statements with bounded memory
+
+Instead of keeping all transactions of an account in memory, the transactions
+of each cleaned statement are sorted and spilled to a temporary "run" file,
+and the runs are merged back with bounded memory, removing duplicates and
+plugging gaps on the fly while writing the output.
+"""
+
+import logging
+import os
+import pickle
+import tempfile
+
+from bookmo import bm_write_csv as bm_write
+
+# minimum size of the read buffer of each run while merging, it determines
+# how many runs can be merged at once within the memory budget
+MIN_BUFFER_SIZE = 64 * 1024
+
+
+def spill_account_statement(account_statement, directory):
+    """
+    Sort the transactions of a cleaned statement and spill them to a run file
+
+    Returns the statement where the list of transactions has been replaced by
+    the 'run' key, the path to the run file, and by 'transactions_count'.
+    """
+    transactions = bm_write.sort_transactions(
+        account_statement.pop('transactions'))
+
+    fd, run_file = tempfile.mkstemp(suffix='.run', dir=directory)
+    with open(fd, mode='wb') as run_fd:
+        write_run(transactions, run_fd)
+    logging.debug("Spilled {tn} transactions from statement file '{sf}' "
+                  "to run file '{rf}'".format(
+                      tn=len(transactions),
+                      sf=os.path.basename(account_statement['file']),
+                      rf=run_file))
+
+    account_statement['run'] = run_file
+    account_statement['transactions_count'] = len(transactions)
+    return account_statement
+
+
+def load_account_statement(account_statement):
+    """
+    Returns a copy of a spilled statement with its transactions read back
+    from its run file into memory
+    """
+    account_statement = account_statement.copy()
+    account_statement['transactions'] = list(
+        read_run(account_statement.pop('run')))
+    del account_statement['transactions_count']
+    return account_statement
+
+
+def write_run(transactions, fd):
+    """
+    Write sorted transactions in a compact binary format to a file object
+    """
+    run_writer = RunWriter(fd)
+    for transaction in transactions:
+        run_writer.write(transaction)
+
+
+class RunWriter():
+    """
+    Write transactions one by one in a compact binary format to a file object
+
+    Each transaction is written as a tuple of the field names not yet seen in
+    the run, a bit mask of the fields present and a tuple of their values,
+    so that field names aren't repeated for each and every transaction.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self.fields = {}
+
+    def write(self, transaction):
+        new_fields = tuple(x for x in transaction if x not in self.fields)
+        for field in new_fields:
+            self.fields[field] = len(self.fields)
+        mask = 0
+        values = []
+        for field, index in self.fields.items():
+            if field in transaction:
+                mask |= 1 << index
+                values.append(transaction[field])
+        pickle.dump((new_fields, mask, tuple(values)), self.fd,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_run(run_file, buffer_size=MIN_BUFFER_SIZE):
+    """
+    Generator reading back the transactions of a run file one by one
+    """
+    fields = []
+    with open(run_file, mode='rb', buffering=buffer_size) as fd:
+        while True:
+            try:
+                new_fields, mask, values = pickle.load(fd)
+            except EOFError:
+                return
+            fields.extend(new_fields)
+            values = iter(values)
+            yield {field: next(values)
+                   for index, field in enumerate(fields)
+                   if mask & (1 << index)}
+
+
+def merge_runs(run_files, buffer_size=MIN_BUFFER_SIZE):
+    """
+    Generator merging sorted runs into one sorted stream of transactions
+
+    Transactions with the same uid are considered duplicates and only the one
+    from the last run is kept, as done by combine_account_statements.
+    """
+    return bm_write.merge_transactions(
+        list(read_run(x, buffer_size) for x in run_files))
+
+
+def combine_account_runs(statements, memory_budget):
+    """
+    Combine the spilled runs of multiple statements from the same account
+
+    The memory budget in MiB determines how many runs can be merged at once,
+    if there are more runs, they are first merged into intermediate runs,
+    which are removed as soon as they've been merged further.
+
+    Generator of transactions sorted by transaction uid
+    """
+    logging.info("Handling account '{ac}'".format(
+        ac=statements[0]['account_uid']))
+
+    budget = memory_budget * 1024 * 1024
+    max_runs = max(2, budget // MIN_BUFFER_SIZE)
+    run_files = []
+    for statement in statements:
+        logging.info(
+            "Combining {tn} transactions from statement file '{sf}'".format(
+                tn=statement['transactions_count'],
+                sf=os.path.basename(statement['file'])))
+        run_files.append(statement['run'])
+
+    # intermediate runs replace the runs they come from at the same place,
+    # so that the order between duplicates is kept, they're written next to
+    # the last run which is always a spilled statement
+    directory = os.path.dirname(run_files[-1])
+    intermediate_runs = set()
+    try:
+        while len(run_files) > max_runs:
+            logging.debug(
+                "Merging {rn} runs into an intermediate run".format(
+                    rn=max_runs))
+            fd, run_file = tempfile.mkstemp(suffix='.run', dir=directory)
+            intermediate_runs.add(run_file)
+            with open(fd, mode='wb') as run_fd:
+                write_run(merge_runs(run_files[:max_runs],
+                                     budget // max_runs), run_fd)
+            for merged_run in intermediate_runs.intersection(
+                    run_files[:max_runs]):
+                os.remove(merged_run)
+                intermediate_runs.remove(merged_run)
+            run_files[:max_runs] = [run_file]
+
+        yield from merge_runs(run_files, budget // len(run_files))
+    finally:
+        for run_file in intermediate_runs:
+            os.remove(run_file)
+
+
+def output_account_runs(statements, outputs, plug_gaps, memory_budget,
+                        categoriser=None, ledger=None):
+    """
+    Merge the spilled runs of multiple statements and write them to one or
+    more files, outputs being a list of (out_file, flavour) pairs
+
+    If a ledger is given, its run is merged as well, before the statements.
+    """
+    if ledger:
+        ledger_statement = ledger.get_statement(in_memory=False)
+        if ledger_statement:
+            statements = [ledger_statement] + statements
+    transactions = combine_account_runs(statements, memory_budget)
+    return bm_write.output_transactions(transactions, outputs, plug_gaps,
+                                        categoriser, ledger)
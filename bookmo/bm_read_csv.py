@@ -2,17 +2,33 @@
 Bookiemoney module to read statements and their transactions from an input file
 """
 
+import bz2
+import collections
 import csv
+import gzip
+import io
 import logging
+import lzma
 import os
 import re
 import yaml
+import zipfile
 
 # identifier for accounts without identifier
 NO_ACCOUNT_UID = 'NOIDENTIFIER'
 
+# how many lines a lines reader can step back
+MAX_STEP_BACK = 16
 
-def read_statement_file(file, flavour):
+# functions to open compressed files, depending on the extension of the file
+DECOMPRESSORS = {
+    'gz': gzip.open,
+    'bz2': bz2.open,
+    'xz': lzma.open,
+}
+
+
+def read_statement_file(file, flavour, coverage=None):
     """
     Reads a statement file of a given flavour (aka bank)
 
@@ -22,6 +38,13 @@ def read_statement_file(file, flavour):
 
     Note that there is only more than one key if the file contains statements
     for more than one account.
+
+    If a coverage index is given, a statement whose date range, read before
+    its transactions, is already covered is kept without transactions, so
+    that the account is still combined with its ledger. If no other account
+    can follow in the file, the rest of the file isn't read at all, else
+    the rows of the statement are only split into fields to find the end of
+    the statement, they're neither mapped nor kept.
     """
 
     # this is a dictionary of dictionaries, where each key is an account ID
@@ -31,7 +54,7 @@ def read_statement_file(file, flavour):
     logging.info("Reading input file '{fi}'".format(fi=file))
 
     # the extension of the file gives us the file type
-    extension = os.path.splitext(file)[1].lstrip('.').lower()
+    extension = get_file_type(file)
 
     # we read accordingly the flavour's configuration file
     flavour_file = os.path.join('in', extension, flavour + '.yml')
@@ -41,24 +64,38 @@ def read_statement_file(file, flavour):
     account_uid = flavour_config['identifier']
 
     # then we match the config line by line with the statement's content
-    lines_reader = LinesReader(file, flavour_config['encoding'])
-
     file_dict = {'file': file, 'flavour': flavour_config}
-    for cfg_line in flavour_config['lines']:
-        if cfg_line['type'] == 'match':
-            result = parse_match(lines_reader, cfg_line)
-        elif cfg_line['type'] == 'csv':
-            result = parse_csv(lines_reader, cfg_line)
-        if result:  # we consider each config line optional
-            # handling the presence of multiple accounts in the same
-            # file but differentiating them by name
-            if (account_uid in result
-                    and account_uid in file_dict
-                    and result[account_uid] != file_dict[account_uid]):
-                file_dict['account_uid'] = file_dict[account_uid]
-                accounts[file_dict['account_uid']] = file_dict
-                file_dict = {'file': file, 'flavour': flavour_config}
-            file_dict |= result
+    with LinesReader(file, flavour_config['encoding']) as lines_reader:
+        for position, cfg_line in enumerate(flavour_config['lines']):
+            if cfg_line['type'] == 'match':
+                result = parse_match(lines_reader, cfg_line)
+            elif cfg_line['type'] == 'csv':
+                if coverage and coverage.covers_statement(
+                        file_dict.get(account_uid, NO_ACCOUNT_UID),
+                        file_dict):
+                    logging.info(
+                        "Skipping statement already covered in file "
+                        "'{fi}'".format(fi=file))
+                    result = {'transactions': []}
+                    if not any(x['type'] == 'csv' for x in
+                               flavour_config['lines'][position + 1:]):
+                        file_dict |= result
+                        break
+                    # the rows must still be read through to get to the
+                    # next account in the file
+                    parse_csv(lines_reader, cfg_line | {'skip': True})
+                else:
+                    result = parse_csv(lines_reader, cfg_line)
+            if result:  # we consider each config line optional
+                # handling the presence of multiple accounts in the same
+                # file but differentiating them by name
+                if (account_uid in result
+                        and account_uid in file_dict
+                        and result[account_uid] != file_dict[account_uid]):
+                    file_dict['account_uid'] = file_dict[account_uid]
+                    accounts[file_dict['account_uid']] = file_dict
+                    file_dict = {'file': file, 'flavour': flavour_config}
+                file_dict |= result
     # then handle the remaining results after the file has been read
     if account_uid in file_dict:
         file_dict['account_uid'] = file_dict[account_uid]
@@ -69,6 +106,92 @@ def read_statement_file(file, flavour):
     return accounts
 
 
+def list_statement_files(files):
+    """
+    Expand a list of statement files, replacing each zip archive by the
+    files it contains
+
+    The members of a zip archive are named as if the archive were a directory,
+    e.g. 'archive.zip/statement.csv', which is understood by
+    open_statement_file. Only the members of a type having input flavours
+    are kept, so that e.g. a README or a PDF in the archive is skipped.
+    """
+    statement_files = []
+    for file in files:
+        if os.path.isfile(file) and zipfile.is_zipfile(file):
+            with zipfile.ZipFile(file) as zfd:
+                for info in zfd.infolist():
+                    if info.is_dir():
+                        continue
+                    member = os.path.join(file, info.filename)
+                    file_type = get_file_type(member)
+                    if file_type and os.path.isdir(os.path.join('in',
+                                                                file_type)):
+                        statement_files.append(member)
+                    else:
+                        logging.warning(
+                            "Skipping file '{fi}' of unknown type "
+                            "'{ft}'".format(fi=member, ft=file_type))
+        else:
+            statement_files.append(file)
+    return statement_files
+
+
+def get_file_type(file):
+    """
+    Returns the type of a statement file according to its extension,
+    ignoring the extension of a compression, e.g. 'csv' for 'file.csv.gz'
+    """
+    root, extension = os.path.splitext(file)
+    extension = extension.lstrip('.').lower()
+    if extension in DECOMPRESSORS:
+        extension = os.path.splitext(root)[1].lstrip('.').lower()
+    return extension
+
+
+def split_archive_path(file):
+    """
+    Split the path of a statement file into the path of the zip archive
+    containing it and the name of the member within the archive
+
+    Returns the file itself and None if the file isn't in a zip archive
+    """
+    # look for an existing archive file "above" the given path
+    archive = file
+    member = []
+    while archive and not os.path.exists(archive):
+        archive, tail = os.path.split(archive)
+        member.insert(0, tail)
+    if member and zipfile.is_zipfile(archive):
+        return archive, '/'.join(member)
+    else:
+        return file, None
+
+
+def open_statement_file(file, encoding):
+    """
+    Open a statement file for reading as text, decompressing it on the fly
+
+    The file can be a member of a zip archive, named as returned by
+    list_statement_files, and/or be compressed according to its extension.
+
+    Returns a text file object
+    """
+    archive, member = split_archive_path(file)
+    if member:
+        with zipfile.ZipFile(archive) as zfd:
+            # the member stays readable after the archive has been closed
+            fd = zfd.open(member)
+    else:
+        fd = open(file, mode='rb')
+
+    extension = os.path.splitext(file)[1].lstrip('.').lower()
+    if extension in DECOMPRESSORS:
+        fd = DECOMPRESSORS[extension](fd)
+
+    return io.TextIOWrapper(fd, encoding=encoding)
+
+
 def parse_match(lr, cfg):
     """
     Try to match the matching config description with the first non-empty line
@@ -99,31 +222,40 @@ def parse_match(lr, cfg):
 
 class LinesReader:
     """
-    Wrapper around a file object providing lines until max_read
+    Wrapper around a file object providing non-empty stripped lines
 
     We need this wrapper because csv.DictReader resp. 'next()' blocks
-    the usage of fd.tell() which we need to step back
+    the usage of fd.tell() which we need to step back.
+    The lines are read one by one from the file, only the last few ones
+    are kept to be able to step back.
     """
-    def __init__(self, file, encoding):
-        with open(file, mode='r', encoding=encoding) as fd:
-            self.lines = list(x.strip() for x in fd.readlines())
-        self.max = len(self.lines)
-        self.line = -1
+    def __init__(self, file, encoding, history=MAX_STEP_BACK):
+        self.fd = open_statement_file(file, encoding)
+        self.history = collections.deque(maxlen=history)
+        self.pushed_back = []
 
     def __next__(self):
-        self.line += 1
-        while self.line < self.max and not self.lines[self.line]:
-            self.line += 1
-        if self.line < self.max:
-            return self.lines[self.line]
+        if self.pushed_back:
+            line = self.pushed_back.pop()
         else:
-            raise StopIteration
+            line = ''
+            while not line:
+                line = next(self.fd).strip()
+        self.history.append(line)
+        return line
 
     def __iter__(self):
         return self
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.fd.close()
+
     def step_back(self, back=1):
-        self.line -= back
+        for _ in range(back):
+            self.pushed_back.append(self.history.pop())
 
 
 def parse_csv(lr, cfg):
@@ -151,6 +283,8 @@ def parse_csv(lr, cfg):
             # the line didn't parse correctly, end of the csv...
             lr.step_back()
             break
+        elif cfg.get('skip', False):
+            continue
         elif ('ignore' in cfg
                 and row[cfg['ignore']['key']] == cfg['ignore']['value']):
             logging.warning("Ignoring transaction '{tr}'".format(tr=row))
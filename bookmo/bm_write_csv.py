@@ -1,54 +1,100 @@
 """
 Bookiemoney module to write statements and their transactions to a CSV file
+(or to a newline delimited JSON file)
 """
 
+import abc
+import contextlib
 import csv
+import heapq
+import itertools
+import json
 import logging
 import os
+import sys
 import yaml
 
 # maximum possible number of transactions each day
 DAILY_TRANSACTIONS = 10000
 
+# output file name standing for the standard output, and its file type
+STDOUT = '-'
+STDOUT_TYPE = 'ndjson'
 
-def output_account_statements(statements, out_file, flavour, plug_gaps):
+
+def output_account_statements(statements, outputs, plug_gaps,
+                              categoriser=None, ledger=None):
     """
-    Combine all transactions of multiple statements and write them to a file
+    Combine all transactions of multiple statements and write them to one or
+    more files, outputs being a list of (out_file, flavour) pairs
+
+    If a ledger is given, the transactions already in the ledger are combined
+    as well, before the statements.
     """
+    if ledger:
+        ledger_statement = ledger.get_statement(in_memory=True)
+        if ledger_statement:
+            statements = [ledger_statement] + statements
     transactions = combine_account_statements(statements)
-    return output_transactions(transactions, out_file, flavour, plug_gaps)
+    return output_transactions(transactions, outputs, plug_gaps, categoriser,
+                               ledger)
 
 
-def combine_account_statements(statement):
+def combine_account_statements(statements):
     """
     Combine the transactions of multiple statements from the same account
 
-    Return a sorted dictionary of transactions where the key is the unique ID
-    of each transaction
+    Returns a generator of transactions sorted by their unique ID, where
+    transactions with the same unique ID from a later statement replace
+    the ones from earlier statements.
     """
-    clean_statement = {}
     # all statement files must have the same account unique ID, hence we take
     # the first one
     logging.info("Handling account '{ac}'".format(
-        ac=statement[0]['account_uid']))
+        ac=statements[0]['account_uid']))
 
-    for file in statement:
+    sorted_statements = []
+    for file in statements:
         logging.info(
             "Combining {tn} transactions from statement file '{sf}'".format(
                 tn=len(file['transactions']),
                 sf=os.path.basename(file['file'])))
-        transaction_uid = TransactionUid()
-        for transaction in file['transactions']:
-            uid = transaction_uid(transaction['transaction_date'])
-            transaction['transaction_uid'] = uid
-            clean_statement[uid] = transaction
+        sorted_statements.append(sort_transactions(file['transactions']))
 
     # TODO identify gaps using the balance values - need to consider existing
     #      entries in the target file at a later stage
-    # sorted_keys_list = sorted(list(clean_statement.keys()))
 
-    # we return a properly sorted dictionary
-    return dict(sorted(clean_statement.items()))
+    return merge_transactions(sorted_statements)
+
+
+def sort_transactions(transactions):
+    """
+    Add a unique ID to each transaction of one statement
+
+    Returns the list of transactions sorted by unique ID
+    """
+    transaction_uid = TransactionUid()
+    for transaction in transactions:
+        transaction['transaction_uid'] = transaction_uid(
+            transaction['transaction_date'])
+    return sorted(transactions, key=lambda x: x['transaction_uid'])
+
+
+def merge_transactions(sorted_statements):
+    """
+    Generator merging iterables of transactions sorted by unique ID into one
+    sorted stream of transactions
+
+    Transactions with the same unique ID are considered duplicates and only
+    the one from the last iterable is kept.
+    """
+    merged = heapq.merge(*sorted_statements,
+                         key=lambda x: x['transaction_uid'])
+    for uid, duplicates in itertools.groupby(
+            merged, key=lambda x: x['transaction_uid']):
+        for transaction in duplicates:
+            pass  # only the last one wins
+        yield transaction
 
 
 class TransactionUid():
@@ -73,11 +119,17 @@ class TransactionUid():
         return datenr + 10 * self.index
 
 
-def output_transactions(transactions, out_file, flavour, plug_gaps):
+def output_transactions(transactions, outputs, plug_gaps, categoriser=None,
+                        ledger=None):
     """
-    Write all transactions into the output file according to flavour.
+    Write all transactions into the output files according to their flavour,
+    outputs being a list of (out_file, flavour) pairs.
 
-    Plug gaps between transaction balance values if plug gaps is True.
+    The transactions are an iterable sorted by unique ID, they're recorded
+    in the ledger if one is given, get category and tags set by the
+    categoriser if one is given, and gaps between transaction balance
+    values are plugged if plug gaps is True (gap transactions not being
+    categorised).
 
     The function could read first the output file and combine it with the
     new transactions, plugging the gaps afterwards, but this possibility
@@ -85,56 +137,184 @@ def output_transactions(transactions, out_file, flavour, plug_gaps):
     Currently the output file is overwritten each time.
     """
 
-    if not transactions.values():
+    if ledger:
+        transactions = ledger(transactions)
+
+    if categoriser:
+        transactions = map(categoriser, transactions)
+
+    if plug_gaps:
+        transactions = plug_gaps_in_statement(transactions)
+
+    return write_transactions(transactions, outputs)
+
+
+def write_transactions(transactions, outputs):
+    """
+    Write an iterable of transactions, sorted by transaction uid, into the
+    output files according to their flavour, outputs being a list of
+    (out_file, flavour) pairs.
+
+    The transactions are consumed one by one and handed over to all output
+    files in one single pass, so that the iterable can be a generator and
+    doesn't need to be held in memory as a whole.
+
+    Returns the list of files written or None if there was nothing to write
+    """
+
+    transactions = iter(transactions)
+    first_transaction = next(transactions, None)
+    if first_transaction is None:
         logging.warning("No transactions to write to output file")
         return None  # nothing to write in a file...
 
-    # an output file can have a placeholder for the account unique ID
-    if "{}" in out_file:
-        # all transactions must have the same account UID so we don't care
-        # and take the first one
-        out_file = out_file.format(
-            next(iter(transactions.values()))['transaction_account_uid'])
+    # all transactions must have the same account UID so we don't care
+    # and take the first one
+    account_uid = first_transaction['transaction_account_uid']
 
-    # the extension of the file gives us the file type
-    extension = os.path.splitext(out_file)[1].lstrip('.').lower()
+    with contextlib.ExitStack() as stack:
+        writers = list(
+            stack.enter_context(get_transactions_writer(x, y, account_uid))
+            for x, y in outputs)
+        for transaction in itertools.chain((first_transaction,),
+                                           transactions):
+            for writer in writers:
+                writer.write(transaction)
 
-    # we read the flavour's configuration file
-    flavour_file = os.path.join('out', extension, flavour + '.yml')
-    with open(flavour_file, mode='r') as yfd:
-        flavour_config = yaml.safe_load(yfd)
+    return list(x.out_file for x in writers)
 
-    # normalize the valour fields to allow for shortcuts
-    normalize_flavour_fields(flavour_config['fields'])
-    # get the list of output fields
-    fields = list(flavour_config['fields'].keys())
 
-    if plug_gaps:
-        transactions = plug_gaps_in_statement(transactions)
+def get_transactions_writer(out_file, flavour, account_uid):
+    """
+    Returns a transactions writer according to the type of the output file,
+    given by its extension
+    """
+    if out_file == STDOUT:
+        file_type = STDOUT_TYPE
+    else:
+        file_type = os.path.splitext(out_file)[1].lstrip('.').lower()
+    return TRANSACTIONS_WRITERS[file_type](out_file, file_type, flavour,
+                                           account_uid)
+
 
-    logging.info("Writing {tr} transactions to output file '{of}'".format(
-        tr=len(transactions), of=out_file))
-    logging.debug(yaml.dump(flavour_config))
-
-    with open(out_file, 'w', newline='') as csvfile:
-        if isinstance(flavour_config['dialect'], str):
-            writer = csv.DictWriter(csvfile, fieldnames=fields,
-                                    dialect=flavour_config['dialect'])
-        else:  # the dialect is a dictionary of CSV options
-            writer = csv.DictWriter(csvfile, fieldnames=fields,
-                                    **flavour_config['dialect'])
-        if flavour_config.get('header', True):
-            writer.writeheader()
-        for uid in transactions:
-            row = {}
-            for field in fields:
-                value = get_field_value(field, transactions[uid],
-                                        flavour_config['fields'][field],
-                                        flavour_config.get('locale'))
-                row[field] = value
-            logging.debug(row)
-            writer.writerow(row)
-    return out_file
+class TransactionsWriter(abc.ABC):
+    """
+    Context manager writing transactions one by one into an output file
+    according to flavour, sub-classed for each type of output file which
+    must at least define how to write a row
+
+    The transactions are written to a temporary file next to the output
+    file, which only replaces the output file once all transactions have
+    been written without error, so that a failure doesn't leave a truncated
+    output file behind.
+    """
+    def __init__(self, out_file, file_type, flavour, account_uid):
+        # an output file can have a placeholder for the account unique ID
+        if "{}" in out_file:
+            out_file = out_file.format(account_uid)
+        self.out_file = out_file
+
+        # we read the flavour's configuration file
+        flavour_file = os.path.join('out', file_type, flavour + '.yml')
+        with open(flavour_file, mode='r') as yfd:
+            self.flavour_config = yaml.safe_load(yfd)
+
+        # normalize the valour fields to allow for shortcuts
+        normalize_flavour_fields(self.flavour_config['fields'])
+        # get the list of output fields
+        self.fields = list(self.flavour_config['fields'].keys())
+        self.count = 0
+
+    def __enter__(self):
+        logging.info("Writing transactions to output file '{of}'".format(
+            of=self.out_file))
+        logging.debug(yaml.dump(self.flavour_config))
+
+        if self.out_file == STDOUT:
+            self.fd = sys.stdout
+        else:
+            # the process ID avoids clashes with another run in parallel
+            self.temp_file = "{of}.{pi}.tmp".format(of=self.out_file,
+                                                    pi=os.getpid())
+            self.fd = open(self.temp_file, 'w', newline='')
+        return self
+
+    def write(self, transaction):
+        row = {}
+        for field in self.fields:
+            value = get_field_value(field, transaction,
+                                    self.flavour_config['fields'][field],
+                                    self.flavour_config.get('locale'))
+            row[field] = value
+        logging.debug(row)
+        self.write_row(row)
+        self.count += 1
+
+    @abc.abstractmethod
+    def write_row(self, row):
+        """
+        Write a row, a dictionary of the output fields, to the output file
+        """
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.fd is sys.stdout:
+            self.fd.flush()
+        else:
+            self.fd.close()
+            if exc_type is None:
+                os.replace(self.temp_file, self.out_file)
+            else:
+                os.remove(self.temp_file)
+                logging.error(
+                    "Output file '{of}' left unchanged after error".format(
+                        of=self.out_file))
+                return
+        logging.info(
+            "{tr} transactions written to output file '{of}'".format(
+                tr=self.count, of=self.out_file))
+
+
+class CsvTransactionsWriter(TransactionsWriter):
+    """
+    Transactions writer for CSV files, according to the flavour's dialect
+    """
+    def __enter__(self):
+        super().__enter__()
+        try:
+            if isinstance(self.flavour_config['dialect'], str):
+                self.writer = csv.DictWriter(
+                    self.fd, fieldnames=self.fields,
+                    dialect=self.flavour_config['dialect'])
+            else:  # the dialect is a dictionary of CSV options
+                self.writer = csv.DictWriter(
+                    self.fd, fieldnames=self.fields,
+                    **self.flavour_config['dialect'])
+            if self.flavour_config.get('header', True):
+                self.writer.writeheader()
+        except Exception:
+            self.__exit__(*sys.exc_info())
+            raise
+        return self
+
+    def write_row(self, row):
+        self.writer.writerow(row)
+
+
+class NdjsonTransactionsWriter(TransactionsWriter):
+    """
+    Transactions writer for newline delimited JSON files, one object per
+    transaction, amounts and dates being written as strings
+    """
+    def write_row(self, row):
+        self.fd.write(json.dumps(row, default=str, ensure_ascii=False))
+        self.fd.write('\n')
+
+
+# the writer class for each type of output file
+TRANSACTIONS_WRITERS = {
+    'csv': CsvTransactionsWriter,
+    'ndjson': NdjsonTransactionsWriter,
+}
 
 
 def normalize_flavour_fields(fields):
@@ -186,46 +366,71 @@ def get_field_value(field, transaction, field_map, out_locale=None):
     return ret_value
 
 
-def plug_gaps_in_statement(statement):
+def plug_gaps_in_statement(transactions):
     """
     If two successive transactions in a statement present a gap in the
     account's balance, add a "gap" transaction to plug it.
 
-    It is assumed that the given statement is a dictionary already sorted by
-    transaction order.
-    The original dictionary of transactions is returned with the found gap
-    transactions added, and sorted again by transaction uid.
+    It is assumed that the given transactions are an iterable already sorted
+    by transaction order.
+    Returns a generator of the same transactions with the found gap
+    transactions added, placed before the first transaction of their day,
+    so that only the transactions of one day are held in memory.
     Note that there will always be a gap transaction if the initial balance
     before the statement isn't zero.
     """
     old_balance = old_uid = 0
+    day_gap_uid = None
+    day_transactions = []
     gaps = {}
-    for uid in statement:
-        new_balance = statement[uid]['transaction_balance_amount']
-        gap_amount = new_balance - (
-            old_balance + statement[uid]['transaction_amount'])
-        if gap_amount != 0:
-            gap_uid = uid - uid % DAILY_TRANSACTIONS - 1
-            logging.warning(
-                "Adding gap plugging transaction '{gt}' of amount {ga} "
-                "between old transaction '{ot}' and new one '{nt}'".format(
-                    gt=gap_uid, ga=gap_amount, ot=old_uid, nt=uid))
-            gaps[gap_uid] = {
-                'transaction_account_uid': statement[uid][
-                    'transaction_account_uid'],
-                'transaction_uid': gap_uid,
-                'transaction_amount': gap_amount,
-                'transaction_currency': statement[uid]['transaction_currency'],
-                'transaction_balance_amount': old_balance + gap_amount,
-                'transaction_balance_currency': statement[uid][
-                    'transaction_balance_currency'],
-                'transaction_payment_type': 'plug_gap',
-                'transaction_counterpart_name': 'plug_gap',
-                'transaction_details': "PLUG GAP between {ot} and {nt}".format(
-                    ot=old_uid, nt=uid)
-            }
+    for transaction in transactions:
+        uid = transaction['transaction_uid']
+        gap_uid = uid - uid % DAILY_TRANSACTIONS - 1
+        if day_transactions and gap_uid != day_gap_uid:
+            yield from gaps.values()
+            yield from day_transactions
+            day_transactions = []
+            gaps = {}
+        day_gap_uid = gap_uid
+        new_balance = transaction['transaction_balance_amount']
+        gap = get_gap_transaction(transaction, old_uid, old_balance,
+                                  new_balance)
+        if gap:
+            gaps[gap_uid] = gap
+        day_transactions.append(transaction)
         old_uid = uid
         old_balance = new_balance
+    yield from gaps.values()
+    yield from day_transactions
+
 
-    # we return a properly sorted dictionary
-    return dict(sorted((statement | gaps).items()))
+def get_gap_transaction(transaction, old_uid, old_balance, new_balance):
+    """
+    Check the balance between the previous transaction and the given one
+
+    Returns a gap transaction plugging the difference or None if there is
+    no gap in the balance.
+    """
+    uid = transaction['transaction_uid']
+    gap_amount = new_balance - (
+        old_balance + transaction['transaction_amount'])
+    if gap_amount == 0:
+        return None
+    gap_uid = uid - uid % DAILY_TRANSACTIONS - 1
+    logging.warning(
+        "Adding gap plugging transaction '{gt}' of amount {ga} "
+        "between old transaction '{ot}' and new one '{nt}'".format(
+            gt=gap_uid, ga=gap_amount, ot=old_uid, nt=uid))
+    return {
+        'transaction_account_uid': transaction['transaction_account_uid'],
+        'transaction_uid': gap_uid,
+        'transaction_amount': gap_amount,
+        'transaction_currency': transaction['transaction_currency'],
+        'transaction_balance_amount': old_balance + gap_amount,
+        'transaction_balance_currency': transaction[
+            'transaction_balance_currency'],
+        'transaction_payment_type': 'plug_gap',
+        'transaction_counterpart_name': 'plug_gap',
+        'transaction_details': "PLUG GAP between {ot} and {nt}".format(
+            ot=old_uid, nt=uid)
+    }
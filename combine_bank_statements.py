@@ -1,12 +1,20 @@
 #!/usr/bin/python
 
 import argparse
+import contextlib
 import logging
 import multiprocessing
+import multiprocessing.pool
+import os
 import sys
+import tempfile
 
 from bookmo import bm_read_csv as bm_read
+from bookmo import bm_categorise
 from bookmo import bm_clean
+from bookmo import bm_coverage
+from bookmo import bm_journal
+from bookmo import bm_merge
 from bookmo import bm_write_csv as bm_write
 
 
@@ -18,16 +26,40 @@ def parse_arguments():
     """
     parser = argparse.ArgumentParser(
         description='Combine multiple bank statements into one file')
-    parser.add_argument('--out', '-o', required=True,
-                        help='name of the output file [mandatory]')
+    parser.add_argument('--out', '-o', required=True, action='append',
+                        help='name of the output file, can be repeated '
+                             'once per output flavour, '
+                             "'-' writes NDJSON to stdout [mandatory]")
     parser.add_argument('--flavour-in', required=True,
                         help='type of the account statement [mandatory]')
-    parser.add_argument('--flavour-out', required=True,
-                        help='type of the output file [mandatory]')
+    parser.add_argument('--flavour-out', required=True, action='append',
+                        help='type of the output file, can be repeated '
+                             'in the same order as the output files '
+                             '[mandatory]')
     parser.add_argument('--plug-gaps', action=argparse.BooleanOptionalAction,
                         help='plug gaps in balance between transactions')
+    parser.add_argument('--rules',
+                        help='rules file to set category and tags of the '
+                             'transactions')
+    parser.add_argument('--ledger', metavar='DIRECTORY',
+                        help='directory keeping the transactions already '
+                             'combined, skipping statements already covered')
+    parser.add_argument('--memory-budget', type=int, metavar='MiB',
+                        help='combine statements out-of-core, spilling them '
+                             'to temporary files, within this memory budget')
+    parser.add_argument('--journal', metavar='DIRECTORY',
+                        help='directory keeping a journal of the run, '
+                             'with the cleaned statements of each file')
+    parser.add_argument('--resume', action=argparse.BooleanOptionalAction,
+                        help='resume the run from its journal, only redoing '
+                             'what failed or changed')
+    parser.add_argument('--executor',
+                        choices=('processes', 'threads', 'serial'),
+                        help='process in parallel with a pool of processes '
+                             '(default) or of threads, or serially')
     parser.add_argument('--serial', action=argparse.BooleanOptionalAction,
-                        help='process serially (makes debugging easier)')
+                        help='process serially (makes debugging easier), '
+                             'short for --executor serial')
     parser.add_argument('inputs', nargs='+', metavar='statements',
                         help='one or more input statement files')
     parser.add_argument(
@@ -36,21 +68,94 @@ def parse_arguments():
         help='which level of messages do you want to see?')
     parser.add_argument('--logfile', help='name of a logfile to send logs to')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if len(args.out) != len(args.flavour_out):
+        parser.error("each output file needs its own output flavour")
+    # the same output twice would be written by two writers at once
+    out_files = list(x if x == bm_write.STDOUT else os.path.abspath(x)
+                     for x in args.out)
+    if len(set(out_files)) != len(out_files):
+        parser.error("each output file can only be given once")
+    if args.resume and not args.journal:
+        parser.error("resuming a run requires its journal")
+    if args.serial:
+        if args.executor not in (None, 'serial'):
+            parser.error("--serial conflicts with --executor {ex}".format(
+                ex=args.executor))
+        args.executor = 'serial'
+    elif args.executor is None:
+        args.executor = 'processes'
 
+    return args
 
-def serial_starmap(function, params):
+
+def get_pool(executor):
+    """
+    Returns a context manager for a pool of processes or threads according
+    to the executor, or for None if processing serially
+    """
+    if executor == 'threads':
+        return multiprocessing.pool.ThreadPool()
+    elif executor == 'processes':
+        return multiprocessing.Pool()
+    else:
+        return contextlib.nullcontext()
+
+
+def run_tasks(pool, tasks):
+    """
+    Run the tasks isolated from each other, in the pool if there is one
+
+    Returns an iterator over the tuples returned by bm_journal.run_isolated,
+    in the order of the tasks
+    """
+    if pool is None:
+        return map(bm_journal.run_isolated, tasks)
+    else:
+        return pool.imap(bm_journal.run_isolated, tasks)
+
+
+def clean_statement(statement, coverage=None):
+    """
+    Clean a statement and remove its transactions already covered, if a
+    coverage index is given
+    """
+    statement = bm_clean.clean_account_statement(statement)
+    if coverage:
+        statement = coverage.remove_covered_transactions(statement)
+    return statement
+
+
+def read_clean_statement_file(file, flavour, coverage=None):
+    """
+    Read a statement file and clean the statements it contains
+
+    Returns the list of cleaned statements
+    """
+    accounts = bm_read.read_statement_file(file, flavour, coverage)
+    return list(clean_statement(statement, coverage)
+                for statement in accounts.values())
+
+
+def read_clean_spill_statement_file(file, flavour, directory, coverage=None):
     """
-    Simulate multiprocessing.Pool().starmap in a serial manner
+    Read a statement file, clean it and spill the statements to run files
+
+    Returns a list of statements without their transactions, which are
+    instead in the run files, so that they don't need to be held in memory
     """
-    return list(function(*x) for x in params)
+    return list(bm_merge.spill_account_statement(statement, directory)
+                for statement in read_clean_statement_file(file, flavour,
+                                                           coverage))
 
 
-def serial_map(function, params):
+def output_account_spilled_statements(statements, *params):
     """
-    Simulate multiprocessing.Pool().map in a serial manner
+    Read back the transactions of spilled statements into memory and
+    combine and write them as bm_write.output_account_statements
     """
-    return list(function(x) for x in params)
+    return bm_write.output_account_statements(
+        list(bm_merge.load_account_statement(x) for x in statements), *params)
 
 
 # MAIN
@@ -67,69 +172,165 @@ if __name__ == "__main__":
         else:
             logging.basicConfig(level=num_loglevel)
 
-    # create a list of input_parameters we can use with pool.starmap
-    input_parameters = list((x, args.flavour_in) for x in args.inputs)
+    serial = args.executor == 'serial'
 
-    logging.debug("Input parameters are '{ip}'".format(ip=input_parameters))
+    # zip archives are replaced by the statement files they contain
+    inputs = bm_read.list_statement_files(args.inputs)
 
-    # read the files, clean them and split them into individual accounts
-    with multiprocessing.Pool() as pool:
-        if args.serial:
-            accounts = serial_starmap(bm_read.read_statement_file,
-                                      input_parameters)
-        else:
-            accounts = pool.starmap(bm_read.read_statement_file,
-                                    input_parameters)
-        statements = []
-        for account_file in accounts:
-            statements.extend(account_file.values())
-        if args.serial:
-            clean_statements = serial_map(bm_clean.clean_account_statement,
-                                          statements)
+    # the coverage index tells which statements can be skipped
+    if args.ledger:
+        os.makedirs(args.ledger, exist_ok=True)
+        coverage = bm_coverage.CoverageIndex(args.ledger)
+    else:
+        coverage = None
+
+    # the journal keeps the cleaned statements of each file, else with a
+    # memory budget, transactions are spilled to a temporary directory
+    journal = None
+    spill_dir = None
+    if args.journal:
+        os.makedirs(args.journal, exist_ok=True)
+        journal = bm_journal.RunJournal(args.journal, args.resume)
+        spill_dir = args.journal
+    elif args.memory_budget:
+        temp_dir = tempfile.TemporaryDirectory(prefix='bookmo_')
+        spill_dir = temp_dir.name
+
+    # create a list of tasks, one per file not yet handled
+    file_statements = {}
+    tasks = []
+    for file in inputs:
+        if journal:
+            statements = journal.get_statements(file, args.flavour_in)
+            if statements is not None:
+                logging.info("Input file '{fi}' already handled".format(
+                    fi=file))
+                file_statements[file] = statements
+                continue
+        if spill_dir:
+            tasks.append((file, read_clean_spill_statement_file,
+                          (file, args.flavour_in, spill_dir, coverage)))
         else:
-            clean_statements = pool.map(bm_clean.clean_account_statement,
-                                        statements)
+            tasks.append((file, read_clean_statement_file,
+                          (file, args.flavour_in, coverage)))
+
+    logging.debug("Input tasks are '{ta}'".format(ta=tasks))
 
-    # sort the statements by same account in a dictionary
+    # read the files and clean them, a failing file is quarantined without
+    # aborting the whole batch
+    quarantined = {}
+    with get_pool(args.executor) as pool:
+        for file, statements, error in run_tasks(pool, tasks):
+            if error is None:
+                file_statements[file] = statements
+            else:
+                quarantined[file] = error
+            if journal:
+                journal.record_input(file, args.flavour_in, statements, error)
+
+    # sort the statements by same account in a dictionary, keeping the
+    # order of the input files
     account_statements = {}
-    for statement in clean_statements:
-        account_uid = statement['account_uid']
-        if account_uid in account_statements:
-            account_statements[account_uid].append(statement)
-        else:
-            account_statements[account_uid] = [statement, ]
+    for file in inputs:
+        for statement in file_statements.get(file, []):
+            account_uid = statement['account_uid']
+            if account_uid in account_statements:
+                account_statements[account_uid].append(statement)
+            else:
+                account_statements[account_uid] = [statement, ]
 
     # make sure we detect if output files could get overwritten
-    if len(account_statements) > 1 and '{}' not in args.out:
-        logging.critical(
-            "Out file {of} doesn't contain {{}}. That would mean overwriting some "
-            "output as there is more than one account in the input files".format(
-                of=args.out))
-        sys.exit(1)
+    # (except on the standard output where transactions are just streamed)
+    for out_file in args.out:
+        if (len(account_statements) > 1 and '{}' not in out_file
+                and out_file != bm_write.STDOUT):
+            logging.critical(
+                "Out file {of} doesn't contain {{}}. That would mean "
+                "overwriting some output as there is more than one account "
+                "in the input files".format(of=out_file))
+            sys.exit(1)
+    outputs = list(zip(args.out, args.flavour_out))
 
-    # write now all statements to one output file per account
-    with multiprocessing.Pool() as pool:
-        statement_parameters = list(
-            (statement, args.out, args.flavour_out, args.plug_gaps)
-            for statement in account_statements.values())
-        if args.serial:
-            result = serial_starmap(bm_write.output_account_statements,
-                                    statement_parameters)
+    # accounts written in parallel would mix their lines on standard output
+    if bm_write.STDOUT in args.out:
+        serial = True
+
+    # the categorisation rules are compiled once for all accounts
+    if args.rules:
+        categoriser = bm_categorise.read_rules_file(args.rules)
+    else:
+        categoriser = None
+
+    # create a list of tasks, one per account not yet written, each account's
+    # ledger being extended by its new statements
+    written = {}
+    signatures = {}
+    tasks = []
+    for account_uid, statements in account_statements.items():
+        if journal:
+            signatures[account_uid] = journal.get_account_signature(
+                statements, outputs, args.plug_gaps, args.rules,
+                args.rules and bm_journal.get_file_signature(args.rules),
+                args.ledger)
+            out_files = journal.get_account_outputs(
+                account_uid, signatures[account_uid])
+            if out_files is not None:
+                logging.info("Account '{ac}' already written".format(
+                    ac=account_uid))
+                written[account_uid] = out_files
+                continue
+        if coverage:
+            ledger = coverage.get_ledger(account_uid, statements)
+        else:
+            ledger = None
+        if args.memory_budget:
+            tasks.append((account_uid, bm_merge.output_account_runs,
+                          (statements, outputs, args.plug_gaps,
+                           args.memory_budget, categoriser, ledger)))
+        elif spill_dir:
+            tasks.append((account_uid, output_account_spilled_statements,
+                          (statements, outputs, args.plug_gaps, categoriser,
+                           ledger)))
         else:
-            result = pool.starmap_async(bm_write.output_account_statements,
-                                        statement_parameters)
-            result.wait()
-
-    # in serial mode, we fail immediately so no need to differentiate
-    if args.serial or result.successful():
-        if not args.serial:
-            result = result.get()
-        logging.debug("Transactions written to files '{fi}'".format(fi=result))
+            tasks.append((account_uid, bm_write.output_account_statements,
+                          (statements, outputs, args.plug_gaps, categoriser,
+                           ledger)))
+
+    # write now all statements to one output file per account, a failing
+    # account doesn't abort the other ones
+    failed = {}
+    with get_pool('serial' if serial else args.executor) as pool:
+        for account_uid, out_files, error in run_tasks(pool, tasks):
+            if error is None:
+                written[account_uid] = out_files
+            else:
+                failed[account_uid] = error
+            if journal:
+                journal.record_account(account_uid, signatures[account_uid],
+                                       out_files, error)
+
+    # each task was logged by the journal as soon as done, the journal file
+    # is only written once at the end
+    if journal:
+        journal.save()
+
+    if args.memory_budget and not journal:
+        temp_dir.cleanup()
+
+    logging.debug("Transactions written to files '{fi}'".format(fi=written))
+    if quarantined or failed:
+        for file, error in quarantined.items():
+            logging.error("Input file '{fi}' quarantined with error "
+                          "'{er}'".format(fi=file, er=error))
+        for account_uid, error in failed.items():
+            logging.error("Account '{ac}' failed with error '{er}'".format(
+                ac=account_uid, er=error))
+        logging.error("Something went wrong, {qn} input file(s) quarantined "
+                      "and {fn} account(s) failed".format(
+                          qn=len(quarantined), fn=len(failed)))
+        sys.exit(1)
+    else:
         logging.info("Everything went well, "
                      "{cs} combined statement file(s) written".format(
-                         cs=len(result)-result.count(None)))
+                         cs=sum(len(x) for x in written.values() if x)))
         sys.exit(0)
-    else:
-        logging.error("Something went wrong, check previous errors "
-                      "and result '{rs}".format(rs=result.get()))
-        sys.exit(1)